@@ -20,9 +20,13 @@ from __future__ import print_function
 
 import gzip
 import os
-import re
 import tarfile
 import glob
+import multiprocessing
+import shutil
+from array import array
+from collections import Counter, deque
+from itertools import islice, repeat
 
 from clint.textui import progress
 
@@ -43,25 +47,177 @@ GO_ID = 1
 EOS_ID = 2
 UNK_ID = 3
 
-# Regular expressions used to tokenize.
-_WORD_SPLIT = re.compile(b"([.,!?\"':;)(])")
-_DIGIT_RE = re.compile(br"\d")
+# Punctuation split into separate tokens, with its space-padded replacement.
+_PUNCT_SPACED = [(c, b" " + c + b" ")
+                 for c in (bytes([p]) for p in b".,!?\"':;)(")]
+# Translation table used to normalize digits, replacing every one by 0.
+_DIGITS_TO_ZERO = bytes.maketrans(b"123456789", b"000000000")
+
+# Size in bytes of the buffer used when writing token-ids files.
+_WRITE_BUFFER_SIZE = 1 << 20
+# Size in bytes of the chunks of lines read when tokenizing a data file.
+_READ_CHUNK_SIZE = 1 << 20
+# Default maximal number of processes counting tokens in create_vocabulary.
+_MAX_DEFAULT_WORKERS = 8
+# Size in bytes of the ranges of a data file counted by each of these tasks.
+_TASK_SIZE = 1 << 26
+# Size in bytes of the buffers used to read the dialogs and write the dataset.
+_FILE_BUFFER_SIZE = 1 << 20
+# Size in bytes of the blocks copied when splitting the dataset files.
+_COPY_BLOCK_SIZE = 1 << 16
+
+
+def _space_punctuation(sentence):
+    """Surround every punctuation character of the sentence by spaces."""
+    for punct, spaced in _PUNCT_SPACED:
+        sentence = sentence.replace(punct, spaced)
+    return sentence
 
 
 def basic_tokenizer(sentence):
     """Very basic tokenizer: split the sentence into a list of tokens."""
-    words = []
-    for space_separated_fragment in sentence.strip().split():
-        words.extend(_WORD_SPLIT.split(space_separated_fragment))
-    return [w for w in words if w]
+    return _space_punctuation(sentence).split()
+
+
+def _read_line_chunks(f, chunk_size=_READ_CHUNK_SIZE):
+    """Read a file in chunks of about chunk_size bytes ending on a newline.
+
+    A chunk always holds whole lines, so it is longer than chunk_size when a
+    line is.
+    """
+    # Pieces of the current chunk, joined once a newline has been read.
+    pieces = []
+    while True:
+        piece = tf.compat.as_bytes(f.read(chunk_size))
+        if not piece:
+            break
+        end = piece.rfind(b"\n") + 1
+        if end == 0:
+            pieces.append(piece)
+        else:
+            pieces.append(piece[:end])
+            yield b"".join(pieces)
+            pieces = [piece[end:]]
+    rest = b"".join(pieces)
+    if rest:
+        yield rest
+
+
+def _preprocessed_lines(f, normalize_digits, space_punctuation):
+    """Yield the lines of a file, without newline, from chunks of lines.
+
+    Digits are normalized and punctuation is spaced (if the corresponding
+    argument is set) once per chunk of lines rather than once per line.
+    """
+    for chunk in _read_line_chunks(f):
+        if normalize_digits:
+            chunk = chunk.translate(_DIGITS_TO_ZERO)
+        if space_punctuation:
+            chunk = _space_punctuation(chunk)
+        lines = chunk.split(b"\n")
+        # Every chunk ends with a newline, except maybe the last one.
+        if not lines[-1]:
+            lines.pop()
+        for line in lines:
+            yield line
+
+
+class _LineRange(object):
+    """Reader of the lines of a file starting in its next size bytes.
+
+    It reads at most size bytes from the file, then the end of the line
+    going on there.
+    """
+
+    def __init__(self, f, size):
+        self._f = f
+        self._remaining = size
+
+    def read(self, n):
+        if self._remaining <= 0:
+            return b""
+        data = tf.compat.as_bytes(self._f.read(min(n, self._remaining)))
+        self._remaining -= len(data)
+        if self._remaining <= 0 and not data.endswith(b"\n"):
+            data += tf.compat.as_bytes(self._f.readline())
+        return data
+
+
+def _count_chunk(vocab, chunk, normalize_digits):
+    """Add the basic_tokenizer tokens of a chunk of sentences to vocab."""
+    if normalize_digits:
+        chunk = chunk.translate(_DIGITS_TO_ZERO)
+    vocab.update(basic_tokenizer(chunk))
+
+
+def _count_range(data_path, start, end, normalize_digits):
+    """Count the basic_tokenizer tokens of the lines starting in [start, end).
+
+    Returns:
+      a pair: the number of newlines read, and a Counter of the tokens.
+    """
+    vocab = Counter()
+    lines = 0
+    with gfile.GFile(data_path, mode="rb") as f:
+        if start > 0:
+            # The line going on at start belongs to the previous range.
+            f.seek(start - 1)
+            start += len(f.readline()) - 1
+        for chunk in _read_line_chunks(_LineRange(f, end - start)):
+            lines += chunk.count(b"\n")
+            _count_chunk(vocab, chunk, normalize_digits)
+    return lines, vocab
+
+
+def _count_in_parallel(data_path, size, normalize_digits, num_workers):
+    """Count the basic_tokenizer tokens of a data file in num_workers processes.
+
+    The file is split into ranges of _TASK_SIZE bytes, each counted by a
+    worker. The counts are merged in file order, so ties are ordered like in
+    a sequential pass. At most 2 * num_workers ranges are in flight: the
+    workers count the next ranges while the first results are merged.
+    """
+    vocab = Counter()
+    counter = 0
+    starts = iter(range(0, size, _TASK_SIZE))
+    pending = deque()
+    pool = multiprocessing.Pool(num_workers)
+
+    def submit(start):
+        pending.append(pool.apply_async(
+            _count_range,
+            (data_path, start, start + _TASK_SIZE, normalize_digits)))
+
+    try:
+        for start in islice(starts, 2 * num_workers):
+            submit(start)
+        while pending:
+            lines, range_vocab = pending.popleft().get()
+            start = next(starts, None)
+            if start is not None:
+                submit(start)
+            counter += lines
+            print("  processing line %d" % counter)
+            vocab.update(range_vocab)
+    finally:
+        pool.terminate()
+    return vocab
 
 
 def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, num_workers=None):
     """Create vocabulary file (if it does not exist yet) from data file.
 
     Data file is assumed to contain one sentence per line. Each sentence is
-    tokenized and digits are normalized (if normalize_digits is set).
+    tokenized and digits are normalized (if normalize_digits is set). With
+    basic_tokenizer, which does not depend on line boundaries, the file is
+    processed in chunks of lines of about 1 MB instead of line-by-line, and
+    files larger than 64 MB are split in ranges counted in parallel by
+    num_workers processes. Each of them holds the tokens of one chunk, about
+    10 MB, and the counts of its range, so the peak memory use grows with
+    num_workers. With the spawn and forkserver start methods (the default on
+    macOS, and on Linux from Python 3.14), every worker also imports this
+    module, and TensorFlow with it.
     Vocabulary contains the most-frequent tokens up to max_vocabulary_size.
     We write it to vocabulary_path in a one-token-per-line format, so that later
     token in the first line gets id=0, second line gets id=1, and so on.
@@ -73,29 +229,38 @@ def create_vocabulary(vocabulary_path, data_path, max_vocabulary_size,
       tokenizer: a function to use to tokenize each data sentence;
         if None, basic_tokenizer will be used.
       normalize_digits: Boolean; if true, all digits are replaced by 0s.
+      num_workers: number of processes counting chunks when tokenizer is None;
+        if None, one per CPU is used, up to 8.
     """
     if not gfile.Exists(vocabulary_path):
         print("Creating vocabulary %s from data %s" %
               (vocabulary_path, data_path))
-        vocab = {}
+        vocab = Counter()
         with gfile.GFile(data_path, mode="rb") as f:
             #print(f)
             counter = 0
-            for line in f:
-                counter += 1
-                if counter % 100000 == 0:
-                    print("  processing line %d" % counter)
-                line = tf.compat.as_bytes(line)
-                tokens = tokenizer(
-                    line) if tokenizer else basic_tokenizer(line)
-                for w in tokens:
-                    word = _DIGIT_RE.sub(b"0", w) if normalize_digits else w
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
-            vocab_list = _START_VOCAB + \
-                sorted(vocab, key=vocab.get, reverse=True)
+            if tokenizer:
+                # Lines are given without newline, as in data_to_token_ids.
+                for line in _preprocessed_lines(f, normalize_digits, False):
+                    counter += 1
+                    if counter % 100000 == 0:
+                        print("  processing line %d" % counter)
+                    vocab.update(tokenizer(line))
+            else:
+                num_workers = num_workers or min(multiprocessing.cpu_count(),
+                                                 _MAX_DEFAULT_WORKERS)
+                size = f.size()
+                if num_workers > 1 and size > _TASK_SIZE:
+                    vocab = _count_in_parallel(data_path, size,
+                                               normalize_digits, num_workers)
+                else:
+                    for chunk in _read_line_chunks(f):
+                        lines = chunk.count(b"\n")
+                        if (counter + lines) // 100000 > counter // 100000:
+                            print("  processing line %d" % (counter + lines))
+                        counter += lines
+                        _count_chunk(vocab, chunk, normalize_digits)
+            vocab_list = _START_VOCAB + [w for w, _ in vocab.most_common()]
             if len(vocab_list) > max_vocabulary_size:
                 vocab_list = vocab_list[:max_vocabulary_size]
             with gfile.GFile(vocabulary_path, mode="wb") as vocab_file:
@@ -127,7 +292,8 @@ def initialize_vocabulary(vocabulary_path):
         with gfile.GFile(vocabulary_path, mode="rb") as f:
             rev_vocab.extend(f.readlines())
         rev_vocab = [tf.compat.as_bytes(line.strip()) for line in rev_vocab]
-        vocab = dict([(x, y) for (y, x) in enumerate(rev_vocab)])
+        # The keys are the rev_vocab objects themselves, no copy is made.
+        vocab = dict(zip(rev_vocab, range(len(rev_vocab))))
         return vocab, rev_vocab
     else:
         raise ValueError("Vocabulary file %s not found.", vocabulary_path)
@@ -152,23 +318,27 @@ def sentence_to_token_ids(sentence, vocabulary,
       a list of integers, the token-ids for the sentence.
     """
 
+    # Normalize digits by 0 before tokenizing, once for the whole sentence.
+    if normalize_digits:
+        sentence = sentence.translate(_DIGITS_TO_ZERO)
     if tokenizer:
         words = tokenizer(sentence)
     else:
         words = basic_tokenizer(sentence)
-    if not normalize_digits:
-        return [vocabulary.get(w, UNK_ID) for w in words]
-    # Normalize digits by 0 before looking words up in the vocabulary.
-    return [vocabulary.get(_DIGIT_RE.sub(b"0", w), UNK_ID) for w in words]
+    get = vocabulary.get
+    unk = UNK_ID
+    return [get(w, unk) for w in words]
 
 
 def data_to_token_ids(data_path, target_path, vocabulary_path,
                       tokenizer=None, normalize_digits=True):
     """Tokenize data file and turn into token-ids using given vocabulary file.
 
-    This function loads data line-by-line from data_path, calls the above
-    sentence_to_token_ids, and saves the result to target_path. See comment
-    for sentence_to_token_ids on the details of token-ids format.
+    This function loads data line-by-line from data_path, turns each line
+    into token-ids like the above sentence_to_token_ids, and saves the result
+    to target_path. See comment for sentence_to_token_ids on the details of
+    token-ids format. Tokens are looked up directly as the decimal bytes of
+    their ids, so no intermediate list of token-ids is built.
 
     Args:
       data_path: path to the data file in one-sentence-per-line format.
@@ -181,18 +351,34 @@ def data_to_token_ids(data_path, target_path, vocabulary_path,
     if not gfile.Exists(target_path):
         print("Tokenizing data in %s" % data_path)
         vocab, _ = initialize_vocabulary(vocabulary_path)
+        # Map every token to the decimal representation of its id.
+        get = dict((w, str(i).encode()) for w, i in vocab.items()).get
+        unk = str(UNK_ID).encode()
         with gfile.GFile(data_path, mode="rb") as data_file:
-            with gfile.GFile(target_path, mode="w") as tokens_file:
+            with gfile.GFile(target_path, mode="wb") as tokens_file:
+                if tokenizer:
+                    lines = _preprocessed_lines(data_file, normalize_digits,
+                                                False)
+                    split = tokenizer
+                else:
+                    # Punctuation is already spaced, as in basic_tokenizer.
+                    lines = _preprocessed_lines(data_file, normalize_digits,
+                                                True)
+                    split = bytes.split
                 counter = 0
-                for line in data_file:
+                # Lines are batched in buf and written once it is large enough.
+                buf = bytearray()
+                for line in lines:
                     # print(line)
                     counter += 1
                     if counter % 100000 == 0:
                         print("  tokenizing line %d" % counter)
-                    token_ids = sentence_to_token_ids(tf.compat.as_bytes(line), vocab,
-                                                      tokenizer, normalize_digits)
-                    tokens_file.write(
-                        " ".join([str(tok) for tok in token_ids]) + "\n")
+                    buf += b" ".join(map(get, split(line), repeat(unk)))
+                    buf += b"\n"
+                    if len(buf) > _WRITE_BUFFER_SIZE:
+                        tokens_file.write(bytes(buf))
+                        buf.clear()
+                tokens_file.write(bytes(buf))
 
 
 
@@ -234,12 +420,14 @@ def rm_one_way_conv(dialogs_path):
         files=glob.glob(os.path.join(dialogs_path+'/**/*.tsv'))
 
         for tsv in files:
-            persons = []
+            persons = set()
             with open(tsv, 'r') as tsv_file:
                 for line in tsv_file:
-                    line_split = line.split('\t')
-                    if line_split[1] not in persons:
-                        persons.append(line_split[1])
+                    #only the sender is needed, the message is not split
+                    persons.add(line.split('\t', 2)[1])
+                    #two persons are enough to keep the conversation
+                    if len(persons) >= 2:
+                        break
             if len(persons) < 2:
                 print('\rRemoving ' + tsv, end='')
                 os.remove(tsv)
@@ -249,6 +437,23 @@ def rm_one_way_conv(dialogs_path):
         print('Already removed.')
 
 
+def _split_file(src_file, split_offset, first_path, second_path):
+    """
+    copy src_file up to the byte split_offset in first_path and the rest of it in second_path
+    """
+    src_file.seek(0, 0)
+    with open(first_path, 'wb') as first_file:
+        remaining = split_offset
+        while remaining > 0:
+            block = src_file.read(min(_COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            first_file.write(block)
+            remaining -= len(block)
+    with open(second_path, 'wb') as second_file:
+        shutil.copyfileobj(src_file, second_file, _COPY_BLOCK_SIZE)
+
+
 def create_my_dataset(dialogs_path, train_enc, train_dec, test_enc, test_dec):
     """
     create the .enc and .dec files from the tsv of the ubuntu dialog ubuntu corpus
@@ -264,22 +469,30 @@ def create_my_dataset(dialogs_path, train_enc, train_dec, test_enc, test_dec):
     files=glob.glob(os.path.join(dialogs_path+'/**/*.tsv'))
     size = len(files)
     count = 1
-    enc_file=open(train_enc+'.tmp', 'w+')
-    dec_file=open(train_dec+'.tmp', 'w+')
-    enc_dec_files = [enc_file, dec_file]
-    str_buffer = ''
+    enc_file=open(train_enc+'.tmp', 'wb+', buffering=_FILE_BUFFER_SIZE)
+    dec_file=open(train_dec+'.tmp', 'wb+', buffering=_FILE_BUFFER_SIZE)
+    #the lines of a dialog are gathered here and written once per dialog
+    enc_buf = bytearray()
+    dec_buf = bytearray()
+    enc_dec_bufs = [enc_buf, dec_buf]
+    #size of the .tmp files and offsets of the end of each of their lines, used to split them
+    enc_size = 0
+    dec_size = 0
+    enc_offsets = array('q')
+    dec_offsets = array('q')
+    str_buffer = bytearray()
     total_line = 0
     for tsv in files:
         print('\rParsing file ' + str(count) +' of ' + str(size) +': ' + tsv + '            ', end='')
         both_found=False
         #last person that have sent a msg
-        last_person = ''
+        last_person = b''
         file_to_write = 0
-        with open(tsv, 'r+') as tsv_file:
+        with open(tsv, 'rb', buffering=_FILE_BUFFER_SIZE) as tsv_file:
             #reading the first message(s) and rm \n:
-            first_line = tsv_file.readline()[:-1]
-            #spliting the line
-            first_line_split = first_line.split('\t')
+            first_line = tsv_file.readline().rstrip(b'\r\n')
+            #spliting the line, a message is cut at its first tab if it has one
+            first_line_split = first_line.split(b'\t', 4)
             #we find the first person
             last_person = first_line_split[1]
             row = 0
@@ -288,51 +501,63 @@ def create_my_dataset(dialogs_path, train_enc, train_dec, test_enc, test_dec):
                 row = 2
             else:
                 row = 3
-            enc_dec_files[file_to_write].write(first_line_split[row])
+            enc_dec_bufs[file_to_write] += first_line_split[row]
             while not both_found:
-                line = tsv_file.readline()[:-1].split('\t')
+                line = tsv_file.readline().rstrip(b'\r\n').split(b'\t', 4)
                 #in some case there is an empty line at the end of the file:
                 if len(line) < 3:
                     both_found = True
                 else:
                     if line[1] != last_person:
-                        enc_dec_files[file_to_write].write('\n')#newline in enc_file
+                        enc_buf += b'\n'#newline in enc_file
+                        enc_offsets.append(enc_size + len(enc_buf))
                         #now I write in the .dec
                         file_to_write = 1
-                        enc_dec_files[file_to_write].write(line[3])
+                        enc_dec_bufs[file_to_write] += line[3]
                         last_person = line[1]
                         total_line += 1
                         both_found = True
                     #this is still a line with only 1 person specified
                     else:
-                        enc_dec_files[file_to_write].write(' ' + line[row]) #I concatenate the separated messages
+                        enc_dec_bufs[file_to_write] += b' ' + line[row] #I concatenate the separated messages
 
             #now we can parse normally:
             for line in tsv_file:
-                line_split = line[:-1].split('\t')
+                line_split = line.rstrip(b'\r\n').split(b'\t', 4)
                 #I verifiy is the line is not empty
                 if len(line_split) > 3:
                     if line_split[1] != last_person:
                         file_to_write = (file_to_write+1) % 2
                         if file_to_write == 0:
-                            enc_dec_files[1].write('\n')
-                            str_buffer = line_split[3]
+                            dec_buf += b'\n'
+                            dec_offsets.append(dec_size + len(dec_buf))
+                            str_buffer = bytearray(line_split[3])
                             last_person = line_split[1]
                         else:
-                            str_buffer += '\n'
-                            enc_dec_files[0].write(str_buffer)
-                            enc_dec_files[1].write(line_split[3])
+                            str_buffer += b'\n'
+                            enc_buf += str_buffer
+                            enc_offsets.append(enc_size + len(enc_buf))
+                            dec_buf += line_split[3]
                             total_line += 1
                             last_person = line_split[1]
                     #the same person send many messages in a row
                     else:
                         if file_to_write == 1:
-                            enc_dec_files[1].write(' ' + line_split[3])
+                            dec_buf += b' '
+                            dec_buf += line_split[3]
                         else:
-                            str_buffer += ' ' +line_split[3]
+                            str_buffer += b' '
+                            str_buffer += line_split[3]
             #rare case where it miss a newline
             if file_to_write == 1:
-                enc_dec_files[1].write('\n')
+                dec_buf += b'\n'
+                dec_offsets.append(dec_size + len(dec_buf))
+        enc_file.write(enc_buf)
+        dec_file.write(dec_buf)
+        enc_size += len(enc_buf)
+        dec_size += len(dec_buf)
+        enc_buf.clear()
+        dec_buf.clear()
         count += 1
     print()
     print('Done!')
@@ -340,30 +565,13 @@ def create_my_dataset(dialogs_path, train_enc, train_dec, test_enc, test_dec):
     #now I split the files to create the 4 files I need:
     #train.enc, train.dec, test.enc, test.dec
     print('Finilizing...', end='')
-    #spliting the enc .tmp file
-    enc_file.seek(0, 0)
+    #the first 3/4 of the lines go in the train files, the rest in the test files
     split = int(total_line*(3/4))
-    count = 0
-    train_enc_f = open(train_enc, 'w+')
-    test_enc_f = open(test_enc, 'w+')
-    for line in enc_file:
-        if count < split:
-            train_enc_f.write(line)
-        else:
-            test_enc_f.write(line)
-        count += 1
-
-    #spliting the dec .tmp file
-    dec_file.seek(0, 0)
-    count = 0
-    train_dec_f = open(train_dec, 'w+')
-    test_dec_f = open(test_dec, 'w+')
-    for line in dec_file:
-        if count < split:
-            train_dec_f.write(line)
-        else:
-            test_dec_f.write(line)
-        count += 1
+    for tmp_file, offsets, train_path, test_path in ((enc_file, enc_offsets, train_enc, test_enc),
+                                                     (dec_file, dec_offsets, train_dec, test_dec)):
+        split_offset = offsets[min(split, len(offsets)) - 1] if split and offsets else 0
+        _split_file(tmp_file, split_offset, train_path, test_path)
+        tmp_file.close()
 
     #rm tmp file
     os.remove(train_enc+'.tmp')